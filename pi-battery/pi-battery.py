@@ -13,13 +13,14 @@ Features:
 - Minimal external deps; efficient (no forking awk/tail/tee)
 
 Notes:
-- Keep the same numeric conventions as the Bash version:
+- All per-sample math is integer; values are kept in exact integer units:
   * bus voltage in mV
-  * shunt voltage in mV (INA219 LSB 10µV → 0.01 mV)
-  * current in A
-  * power in W
+  * shunt voltage in 10 µV (INA219 shunt LSB)
+  * current in nA (CURRENT_LSB is 152.4 µA)
+  * power in µW
   * current_now in µA, charge in µAh when writing to BATFILE
-- Averages: rolling buffer up to MAX_HISTORY (default 500); if buffer shorter than AVG_WINDOW, fall back to the latest sample (like the original logic).
+  Floats only appear in the DEBUG report (mV / A / W, like the Bash version).
+- Averages: moving average over the last AVG_WINDOW samples; until AVG_WINDOW samples are collected, fall back to the latest sample (like the original logic).
 
 Author: ChatGPT (Python port)
 """
@@ -30,12 +31,17 @@ import sys
 import time
 import math
 import errno
-from collections import deque
+import queue
+import signal
+import threading
+import stat
+import struct
+from array import array
 from dataclasses import dataclass
 from datetime import datetime
 
 try:
-    from smbus2 import SMBus
+    from smbus2 import SMBus, i2c_msg
 except Exception as e:
     print("ERROR: smbus2 is required (pip install smbus2)", file=sys.stderr)
     raise
@@ -65,13 +71,14 @@ CALIBRATION_FILE = "/var/lib/batmon/calibration_data"
 
 # Averaging behavior
 AVG_WINDOW = 20
-MAX_HISTORY = 500
 
 # Loop behavior
 SAMPLE_PERIOD_S = 2.0
+BATFILE_REFRESH_S = 60.0  # rewrite BATFILE at least this often even if unchanged
 
 # Dynamic calibration
 CALIBRATION_INTERVAL_S = 3600
+CALIBRATION_SAVE_INTERVAL_S = 6 * 3600  # persist pending calibration at least this often
 
 # Status thresholds (mV across shunt)
 THRESHOLD_DISCHARGE_mV = -3.0
@@ -84,6 +91,17 @@ BAT_CAPACITY_mAh = BAT_CELLS * BAT_CELL_CAPACITY_mAh
 BAT_VOLTAGE_FULL_mV = BAT_VOLTAGE_HIGH_mV * BAT_CELLS
 BAT_VOLTAGE_EMPTY_mV = BAT_VOLTAGE_LOW_mV * BAT_CELLS
 BAT_VOLTAGE_HYST_mV = VOLTAGE_HYSTERESIS_mV * BAT_CELLS
+BAT_VOLTAGE_RANGE_mV = BAT_VOLTAGE_FULL_mV - BAT_VOLTAGE_EMPTY_mV
+BAT_VOLTAGE_CALIB_mV = BAT_VOLTAGE_FULL_mV - BAT_VOLTAGE_HYST_mV  # full-charge detection threshold
+
+# INA219 LSBs and status thresholds in the integer units used per sample
+CURRENT_LSB_nA = round(CURRENT_LSB_mA * 1_000_000)
+POWER_LSB_uW = round(POWER_LSB_W * 1_000_000)
+THRESHOLD_DISCHARGE_10uV = round(THRESHOLD_DISCHARGE_mV * 100)
+THRESHOLD_CHARGE_10uV = round(THRESHOLD_CHARGE_mV * 100)
+
+_CAL_DIR = os.path.dirname(CALIBRATION_FILE)
+_CAL_TMP = CALIBRATION_FILE + ".tmp"
 
 # =====================
 # INA219 registers
@@ -95,21 +113,54 @@ REG_POWER = 0x03
 REG_CURRENT = 0x04
 REG_CALIBRATION = 0x05
 
+# Config: 16V range, 320mV shunt, 12bit x32 samples, continuous mode
+CONFIG = (0x00 << 13) | (0x03 << 11) | (0x0D << 7) | (0x0D << 3) | 0x07
+
+# Register payloads for configure(), MSB first as the INA219 expects
+_CFG_BYTES = bytes([(CONFIG >> 8) & 0xFF, CONFIG & 0xFF])
+_CAL_BYTES = bytes([(CALIBRATION >> 8) & 0xFF, CALIBRATION & 0xFF])
+
+# Registers fetched every sample, in the order they are unpacked
+# (keep in sync with the struct format in INA219.read_all)
+READ_REGS = (REG_SHUNTVOLTAGE, REG_BUSVOLTAGE, REG_POWER, REG_CURRENT)
+
 
 @dataclass
 class HistAvg:
-    maxlen: int = MAX_HISTORY
+    width: int = 1
     win: int = AVG_WINDOW
 
     def __post_init__(self):
-        self.buf = deque(maxlen=self.maxlen)
-
-    def add(self, value: float) -> float:
-        self.buf.append(float(value))
-        if len(self.buf) >= self.win:
-            return sum(self.buf) / len(self.buf)
-        # fallback to the latest value if not enough samples yet (like original)
-        return float(value)
+        # one row-major ring for all channels (row = one sample of every channel)
+        # with an exact integer running total per channel: O(1) per sample, no sum()
+        self.buf = array("q", [0] * (self.win * self.width))
+        self.totals = [0] * self.width
+        self.idx = 0
+        self.count = 0
+
+    def add(self, *values: int) -> tuple[int, ...]:
+        buf = self.buf
+        totals = self.totals
+        base = self.idx * self.width
+        for i, x in enumerate(values):
+            # slot holds the evicted sample once full, 0 while still filling
+            totals[i] += x - buf[base + i]
+            buf[base + i] = x
+        self.idx = (self.idx + 1) % self.win
+        if self.count < self.win:
+            self.count += 1
+        if self.count >= self.win:
+            # rounded to nearest
+            half = self.win // 2
+            return tuple((t + half) // self.win for t in totals)
+        # fallback to the latest values if not enough samples yet (like original)
+        return values
+
+    def mean(self, i: int) -> float:
+        # unrounded average of channel i (same fallback as add()), for display only
+        if self.count >= self.win:
+            return self.totals[i] / self.win
+        return float(self.buf[(self.idx - 1) % self.win * self.width + i])
 
 
 class INA219:
@@ -117,6 +168,16 @@ class INA219:
         self.bus_num = bus
         self.addr = addr
         self.bus = SMBus(bus)
+        # combined I2C_RDWR transfer; cleared if the adapter rejects it
+        self.combined_read = True
+        # INA219 has no register auto-increment, so each register is selected with a
+        # write and read back with a repeated start. The messages (and their ctypes
+        # buffers) are built once and reused for every sample.
+        self._read_msgs = []
+        for reg in READ_REGS:
+            self._read_msgs.append(i2c_msg.write(addr, [reg]))
+            self._read_msgs.append(i2c_msg.read(addr, 2))
+        self._read_bufs = self._read_msgs[1::2]
 
     def close(self):
         try:
@@ -124,60 +185,69 @@ class INA219:
         except Exception:
             pass
 
-    def _write_u16(self, reg: int, value: int) -> None:
-        # INA219 expects MSB first
-        msb = (value >> 8) & 0xFF
-        lsb = value & 0xFF
-        self.bus.write_i2c_block_data(self.addr, reg, [msb, lsb])
-
-    def _read_u16(self, reg: int) -> int:
-        # Read two bytes, MSB first
-        data = self.bus.read_i2c_block_data(self.addr, reg, 2)
-        return (data[0] << 8) | data[1]
-
-    @staticmethod
-    def _to_signed_16(val: int) -> int:
-        return val - 0x10000 if val & 0x8000 else val
+    def _read_regs_combined(self) -> bytes:
+        # all registers in a single I2C_RDWR ioctl instead of one SMBus transaction each
+        self.bus.i2c_rdwr(*self._read_msgs)
+        return b"".join(bytes(m) for m in self._read_bufs)
+
+    def _read_regs(self) -> bytes:
+        if self.combined_read:
+            try:
+                return self._read_regs_combined()
+            except OSError as e:
+                # only an adapter without I2C_RDWR support disables the combined read;
+                # transient bus errors (NAK, timeout) retry it on the next sample
+                if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                    print(f"WARN: Combined I2C read unsupported ({e}), using per-register reads", file=sys.stderr)
+                    self.combined_read = False
+        return b"".join(bytes(self.bus.read_i2c_block_data(self.addr, reg, 2)) for reg in READ_REGS)
 
     def configure(self):
-        # Write calibration
-        self._write_u16(REG_CALIBRATION, CALIBRATION)
-        # Config: 16V range, 320mV shunt, 12bit x32 samples, continuous mode
-        config = ((0x00 << 13) | (0x03 << 11) | (0x0D << 7) | (0x0D << 3) | 0x07)
-        self._write_u16(REG_CONFIG, config)
+        # Write calibration, then config
+        try:
+            self.bus.i2c_rdwr(
+                i2c_msg.write(self.addr, bytes([REG_CALIBRATION]) + _CAL_BYTES),
+                i2c_msg.write(self.addr, bytes([REG_CONFIG]) + _CFG_BYTES),
+            )
+        except OSError:
+            # adapter without I2C_RDWR support
+            self.bus.write_i2c_block_data(self.addr, REG_CALIBRATION, _CAL_BYTES)
+            self.bus.write_i2c_block_data(self.addr, REG_CONFIG, _CFG_BYTES)
 
     def read_all(self):
-        bus_raw = self._read_u16(REG_BUSVOLTAGE)
-        shunt_raw_u = self._read_u16(REG_SHUNTVOLTAGE)
-        current_raw_u = self._read_u16(REG_CURRENT)
-        power_raw_u = self._read_u16(REG_POWER)
-
-        shunt_raw = self._to_signed_16(shunt_raw_u)
-        current_raw = self._to_signed_16(current_raw_u)
-        power_raw = self._to_signed_16(power_raw_u)
+        # MSB first; shunt/power/current are signed, bus voltage is unsigned
+        shunt_raw, bus_raw, power_raw, current_raw = struct.unpack(">hHhh", self._read_regs())
 
         # Bus voltage: [15:3]*4mV
         bus_voltage_mV = ((bus_raw >> 3) & 0x1FFF) * 4
-        # Shunt voltage: 10 µV LSB → 0.01 mV
-        shunt_voltage_mV = shunt_raw * 0.01
-        # Current: CURRENT_LSB is in mA/bit, convert to A
-        current_A = (current_raw * CURRENT_LSB_mA) / 1000.0
-        # Power: in W via POWER_LSB
-        power_W = power_raw * POWER_LSB_W
+        # Shunt voltage: the raw value already is in 10 µV units
+        shunt_voltage_10uV = shunt_raw
+        # Current: CURRENT_LSB in nA/bit (exact)
+        current_nA = current_raw * CURRENT_LSB_nA
+        # Power: POWER_LSB in µW/bit (exact)
+        power_uW = power_raw * POWER_LSB_uW
 
-        return bus_raw, shunt_raw, current_raw, power_raw, bus_voltage_mV, shunt_voltage_mV, current_A, power_W
+        return bus_raw, shunt_raw, current_raw, power_raw, bus_voltage_mV, shunt_voltage_10uV, current_nA, power_uW
 
 
 class BatteryEstimator:
+    # calibration directory created (once per process)
+    _ensured_dir = False
+
     def __init__(self):
-        self.volt_hist = HistAvg()
-        self.shunt_hist = HistAvg()
-        self.curr_hist = HistAvg()
-        self.power_hist = HistAvg()
+        # voltage, |shunt|, |current|, power
+        self.hist = HistAvg(width=4)
 
         # dynamic calibration state
         self.dynamic_charge_full_uAh = BAT_CAPACITY_mAh * 1000  # µAh
-        self.last_calibration_time = 0
+        # time.monotonic() of the last calibration; persisted as wall-clock time
+        self.last_calibration_time = -math.inf
+        # calibration changes are kept in memory and flushed on exit / periodically
+        self._dirty = False
+        self._last_save_time = time.monotonic()
+        self._save_lock = threading.Lock()
+        self._save_queue = queue.Queue(maxsize=1)
+        threading.Thread(target=self._save_writer, name="calibration-writer", daemon=True).start()
         self._load_calibration()
 
     # -------- calibration persistence --------
@@ -193,22 +263,69 @@ class BatteryEstimator:
                         if k == "DYNAMIC_CHARGE_FULL":
                             self.dynamic_charge_full_uAh = int(v)
                         elif k == "LAST_CALIBRATION_TIME":
-                            self.last_calibration_time = int(v)
+                            # wall-clock seconds → monotonic timeline; clamp to now so a
+                            # clock still behind the stamp (no RTC, before NTP) can't
+                            # push the next calibration into the far future
+                            self.last_calibration_time = min(
+                                time.monotonic() - (time.time() - int(v)), time.monotonic()
+                            )
         except FileNotFoundError:
             pass
         except Exception as e:
             print(f"WARN: Failed to load calibration: {e}", file=sys.stderr)
 
-    def _save_calibration(self):
+    def _calibration_snapshot(self) -> tuple[int, int]:
+        last_calibration_wall = int(time.time() - (time.monotonic() - self.last_calibration_time))
+        return self.dynamic_charge_full_uAh, last_calibration_wall
+
+    def _write_calibration(self, charge_full_uAh: int, last_calibration_wall: int) -> bool:
+        # serialized: the writer thread and the exit flush may both get here
+        with self._save_lock:
+            try:
+                if not BatteryEstimator._ensured_dir:
+                    os.makedirs(_CAL_DIR, exist_ok=True)
+                    BatteryEstimator._ensured_dir = True
+                with open(_CAL_TMP, "w") as f:
+                    f.write(f"DYNAMIC_CHARGE_FULL={charge_full_uAh}\n")
+                    f.write(f"LAST_CALIBRATION_TIME={last_calibration_wall}\n")
+                os.replace(_CAL_TMP, CALIBRATION_FILE)
+                return True
+            except Exception as e:
+                print(f"WARN: Failed to save calibration: {e}", file=sys.stderr)
+                return False
+
+    def _save_writer(self):
+        # background thread: disk latency never delays the I2C sampling loop
+        while True:
+            snapshot = self._save_queue.get()
+            try:
+                if not self._write_calibration(*snapshot):
+                    self._dirty = True  # retry on the next periodic save
+            finally:
+                self._save_queue.task_done()
+
+    def _request_save(self):
+        # clear before enqueuing so a fast writer failure (which re-sets _dirty) isn't lost
+        last_save_time = self._last_save_time
+        self._dirty = False
+        self._last_save_time = time.monotonic()
         try:
-            os.makedirs(os.path.dirname(CALIBRATION_FILE), exist_ok=True)
-            tmp = CALIBRATION_FILE + ".tmp"
-            with open(tmp, "w") as f:
-                f.write(f"DYNAMIC_CHARGE_FULL={self.dynamic_charge_full_uAh}\n")
-                f.write(f"LAST_CALIBRATION_TIME={self.last_calibration_time}\n")
-            os.replace(tmp, CALIBRATION_FILE)
-        except Exception as e:
-            print(f"WARN: Failed to save calibration: {e}", file=sys.stderr)
+            self._save_queue.put_nowait(self._calibration_snapshot())
+        except queue.Full:
+            # a save is already pending; stay dirty and retry next sample
+            self._dirty = True
+            self._last_save_time = last_save_time
+
+    def _save_calibration(self):
+        if self._write_calibration(*self._calibration_snapshot()):
+            self._dirty = False
+        self._last_save_time = time.monotonic()
+
+    def flush_calibration(self):
+        # let a queued background save finish, then write anything still pending
+        self._save_queue.join()
+        if self._dirty:
+            self._save_calibration()
 
     # -------- core computations --------
     @staticmethod
@@ -218,26 +335,24 @@ class BatteryEstimator:
         if v_mV <= BAT_VOLTAGE_EMPTY_mV:
             return 0
         num = (v_mV - BAT_VOLTAGE_EMPTY_mV) * 100
-        den = (BAT_VOLTAGE_FULL_mV - BAT_VOLTAGE_EMPTY_mV)
-        # ceil toward up like Bash (int(result) + 1 for non-integers)
-        p = num / den
-        return int(math.ceil(p))
+        # ceil toward up like Bash (int(result) + 1 for non-integers), in integers
+        return (num + BAT_VOLTAGE_RANGE_mV - 1) // BAT_VOLTAGE_RANGE_mV
 
-    def calibrate_if_full(self, voltage_mV: int, charge_now_uAh: int, now_s: int):
+    def calibrate_if_full(self, voltage_mV: int, charge_now_uAh: int, now_s: float):
         if now_s - self.last_calibration_time < CALIBRATION_INTERVAL_S:
             return
-        if voltage_mV >= (BAT_VOLTAGE_FULL_mV - BAT_VOLTAGE_HYST_mV):
+        if voltage_mV >= BAT_VOLTAGE_CALIB_mV:
             if charge_now_uAh < self.dynamic_charge_full_uAh:
                 # smooth update: 19:1 like original
                 self.dynamic_charge_full_uAh = (self.dynamic_charge_full_uAh * 19 + charge_now_uAh) // 20
                 self.last_calibration_time = now_s
-                self._save_calibration()
+                self._dirty = True
 
     @staticmethod
-    def status_from_shunt_mV(shunt_mV: float) -> int:
-        if shunt_mV < THRESHOLD_DISCHARGE_mV:
+    def status_from_shunt_10uV(shunt_10uV: int) -> int:
+        if shunt_10uV < THRESHOLD_DISCHARGE_10uV:
             return 2  # discharging
-        if shunt_mV > THRESHOLD_CHARGE_mV:
+        if shunt_10uV > THRESHOLD_CHARGE_10uV:
             return 1  # charging
         return 0      # full or small current
 
@@ -247,52 +362,54 @@ class BatteryEstimator:
         m = (seconds % 3600) // 60
         return f"{h} h {m:02d} min"
 
-    def step(self, bus_voltage_mV: int, shunt_voltage_mV: float, current_A: float, power_W: float):
-        bus_voltage_avg_mV = int(round(self.volt_hist.add(bus_voltage_mV)))
-        shunt_voltage_abs_mV = abs(shunt_voltage_mV)
-        shunt_voltage_avg_mV = self.shunt_hist.add(shunt_voltage_abs_mV)
-        current_abs_A = abs(current_A)
-        current_avg_A = self.curr_hist.add(current_abs_A)
-        power_avg_W = self.power_hist.add(power_W)
+    def step(self, bus_voltage_mV: int, shunt_voltage_10uV: int, current_nA: int, power_uW: int):
+        current_abs_nA = abs(current_nA)
+        bus_voltage_avg_mV, shunt_voltage_avg_10uV, current_avg_nA, power_avg_uW = self.hist.add(
+            bus_voltage_mV, abs(shunt_voltage_10uV), current_abs_nA, power_uW
+        )
 
         soc_pct = self.soc_percent_from_voltage_mV(bus_voltage_avg_mV)
         charge_full_uAh = self.dynamic_charge_full_uAh
         charge_now_uAh = (charge_full_uAh * soc_pct) // 100
-        current_now_uA = int(current_abs_A * 1_000_000)
-        current_now_avg_uA = int(current_avg_A * 1_000_000)
+        current_now_uA = current_abs_nA // 1000
+        current_now_avg_uA = current_avg_nA // 1000
 
-        now_s = int(time.time())
+        now_s = time.monotonic()
         self.calibrate_if_full(bus_voltage_mV, charge_now_uAh, now_s)
+        if self._dirty and now_s - self._last_save_time >= CALIBRATION_SAVE_INTERVAL_S:
+            self._request_save()
 
-        status_int = self.status_from_shunt_mV(shunt_voltage_mV)
+        status_int = self.status_from_shunt_10uV(shunt_voltage_10uV)
 
         # --- Mobile-like behavior: clamp near 100% ---
         #if soc_pct >= 94 and status_int in (0, 1):
         #    soc_pct = 100
         #    status_int = 0   # force "Full"
-        if soc_pct >= 100 or (soc_pct >= BAT_FULL_CLAMP and status_int in (0, 1)):
-            soc_pct = 100
-            charge_now_uAh = charge_full_uAh   # >>> TADY přidáno <<<
-            current_now_uA = 1000
-            status_int = 0
+        # (BAT_FULL_CLAMP <= 100, so the common below-clamp case is a single test)
+        if soc_pct >= BAT_FULL_CLAMP:
+            if soc_pct >= 100 or status_int in (0, 1):
+                soc_pct = 100
+                charge_now_uAh = charge_full_uAh   # >>> TADY přidáno <<<
+                current_now_uA = 1000
+                status_int = 0
         # --------------------------------------------
 
-        if status_int == 2:  # discharging
-            battery_remain_sec = 0 if current_now_avg_uA <= 0 else int((charge_now_uAh / max(current_now_avg_uA, 1)) * 3600)
-        elif status_int == 1:  # charging
-            battery_remain_sec = 0 if current_now_avg_uA <= 0 else int(((charge_full_uAh - charge_now_uAh) / max(current_now_avg_uA, 1)) * 3600)
-        else:
-            battery_remain_sec = 0
+        battery_remain_sec = 0
+        if current_now_avg_uA > 0:
+            if status_int == 2:  # discharging
+                battery_remain_sec = charge_now_uAh * 3600 // current_now_avg_uA
+            elif status_int == 1:  # charging
+                battery_remain_sec = (charge_full_uAh - charge_now_uAh) * 3600 // current_now_avg_uA
 
         return {
             "bus_voltage_mV": bus_voltage_mV,
             "bus_voltage_avg_mV": bus_voltage_avg_mV,
-            "shunt_voltage_mV": shunt_voltage_mV,
-            "shunt_voltage_avg_mV": shunt_voltage_avg_mV,
-            "current_A": current_A,
-            "current_avg_A": current_avg_A,
-            "power_W": power_W,
-            "power_avg_W": power_avg_W,
+            "shunt_voltage_10uV": shunt_voltage_10uV,
+            "shunt_voltage_avg_10uV": shunt_voltage_avg_10uV,
+            "current_nA": current_nA,
+            "current_avg_nA": current_avg_nA,
+            "power_uW": power_uW,
+            "power_avg_uW": power_avg_uW,
             "soc_pct": soc_pct,
             "charge_full_uAh": charge_full_uAh,
             "charge_now_uAh": charge_now_uAh,
@@ -306,24 +423,83 @@ class BatteryEstimator:
 STATUS_MAP = {0: "Full", 1: "Charging", 2: "Discharging"}
 
 
+# BATFILE block, formatted straight to bytes for os.write()
+_BATFILE_FMT = (
+    b"voltage_min_design=%d\n"
+    b"voltage_now=%d\n"
+    b"current_now=%d\n"
+    b"charge_full_design=%d\n"
+    b"charge_full=%d\n"
+    b"charge_now=%d\n"
+    b"capacity=%d\n"
+    b"charging=%d\n"
+)
+
+# last BATFILE content (noise-rounded) and when it was written
+_last_key = None
+_last_write_s = 0.0
+# whether BATFILE is a plain file (e.g. testing without the kernel module); checked once
+_batfile_regular = None
+
+
+def _batfile_is_regular() -> bool:
+    global _batfile_regular
+    if _batfile_regular is None:
+        try:
+            _batfile_regular = stat.S_ISREG(os.stat(BATFILE).st_mode)
+        except FileNotFoundError:
+            return True  # would be created as a regular file; check again next time
+    return _batfile_regular
+
+
 def write_batfile(payload: dict) -> None:
-    lines = []
-    voltage_min_design_mV = BAT_VOLTAGE_EMPTY_mV
-    lines.append(f"voltage_min_design={voltage_min_design_mV * 1000}")  # to µV
-    lines.append(f"voltage_now={payload['bus_voltage_mV'] * 1000}")     # to µV
-    lines.append(f"current_now={payload['current_now_uA']}")
-    lines.append(f"charge_full_design={BAT_CAPACITY_mAh * 1000}")       # to µAh
-    lines.append(f"charge_full={payload['charge_full_uAh']}")
-    lines.append(f"charge_now={payload['charge_now_uAh']}")
-    lines.append(f"capacity={payload['soc_pct']}")
-    charging = 1 if payload['status_int'] in (0, 1) else 0
-    lines.append(f"charging={charging}")
+    global _last_key, _last_write_s
 
-    data = "\n".join(lines) + "\n"
+    charging = 1 if payload['status_int'] in (0, 1) else 0
+    # skip the write if only sensor noise (<10 mV, <10 mA) changed since the last one
+    key = (
+        payload['bus_voltage_mV'] // 10,
+        payload['current_now_uA'] // 10_000,
+        payload['charge_full_uAh'],
+        payload['charge_now_uAh'],
+        payload['soc_pct'],
+        charging,
+    )
+    now_s = time.monotonic()
+    if key == _last_key and now_s - _last_write_s < BATFILE_REFRESH_S:
+        return
+
+    data = _BATFILE_FMT % (
+        BAT_VOLTAGE_EMPTY_mV * 1000,        # voltage_min_design, to µV
+        payload['bus_voltage_mV'] * 1000,   # voltage_now, to µV
+        payload['current_now_uA'],
+        BAT_CAPACITY_mAh * 1000,            # charge_full_design, to µAh
+        payload['charge_full_uAh'],
+        payload['charge_now_uAh'],
+        payload['soc_pct'],
+        charging,
+    )
 
     try:
-        with open(BATFILE, "w") as f:
-            f.write(data)
+        if _batfile_is_regular():
+            # atomic replace so readers never see a truncated/partial block;
+            # no fsync, this is volatile status data
+            tmp = BATFILE + ".tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.replace(tmp, BATFILE)
+        else:
+            # the kernel module needs the whole block in a single write()
+            fd = os.open(BATFILE, os.O_WRONLY)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        _last_key = key
+        _last_write_s = now_s
     except OSError as e:
         if e.errno == errno.ENOENT:
             # optional: create device file or warn
@@ -332,17 +508,25 @@ def write_batfile(payload: dict) -> None:
             print(f"WARN: Failed to write BATFILE: {e}", file=sys.stderr)
 
 
+def _on_sigterm(signum, frame):
+    # turn systemd's stop into a normal exit so main()'s cleanup runs
+    raise SystemExit(0)
+
+
 def main():
     # Optional debug based on env
     DEBUG = os.environ.get("DEBUG", "0") == "1"
 
     ina = INA219(I2C_BUS, I2C_ADDR)
     est = BatteryEstimator()
+    signal.signal(signal.SIGTERM, _on_sigterm)
 
     try:
         ina.configure()
         time.sleep(1.0)
 
+        # absolute schedule so the sample period doesn't drift by the loop's own runtime
+        next_t = time.monotonic()
         while True:
             (
                 bus_raw,
@@ -350,63 +534,78 @@ def main():
                 current_raw,
                 power_raw,
                 bus_voltage_mV,
-                shunt_voltage_mV,
-                current_A,
-                power_W,
+                shunt_voltage_10uV,
+                current_nA,
+                power_uW,
             ) = ina.read_all()
 
             payload = est.step(
                 bus_voltage_mV=bus_voltage_mV,
-                shunt_voltage_mV=shunt_voltage_mV,
-                current_A=current_A,
-                power_W=power_W,
+                shunt_voltage_10uV=shunt_voltage_10uV,
+                current_nA=current_nA,
+                power_uW=power_uW,
             )
 
             write_batfile(payload)
 
             if DEBUG:
+                # convert to the Bash script's display units (mV / A / W) only here
+                shunt_voltage_mV = shunt_voltage_10uV / 100
+                current_A = current_nA / 1e9
+                power_W = power_uW / 1e6
+                current_avg_A = payload['current_avg_nA'] / 1e9
+                out = []
                 t=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                print(f"--- [{t}] -------------------------\n")
+                out.append(f"--- [{t}] -------------------------\n")
                 # mirror the Bash diagnostic prints, condensed
-                print("Battery values\n---------------------------------------------------")
-                print(f"bus_raw:             {bus_raw}")
-                print(f"bus_voltage:         {bus_voltage_mV} mV")
-                print(f"bus_voltage_avg:     {payload['bus_voltage_avg_mV']} mV\n")
-
-                print(f"shunt_raw:           {shunt_raw}")
-                print(f"shunt_voltage:       {shunt_voltage_mV:.3f} mV")
-                print(f"shunt_voltage_avg:   {payload['shunt_voltage_avg_mV']:.3f} mV\n")
-
-                print(f"current_raw:         {current_raw}")
-                print(f"current:             {current_A:.6f} A")
-                print(f"current_avg:         {payload['current_avg_A']:.6f} A\n")
-
-                print(f"power:               {power_W:.3f} W")
-                print(f"power_avg:           {payload['power_avg_W']:.3f} W\n")
-
-                print("Battery info\n---------------------------------------------------")
-                print(f"Design capacity:     {BAT_CAPACITY_mAh} mAh ({BAT_CELL_CAPACITY_mAh} mAh * {BAT_CELLS})")
-                print(f"Last max. capacity:  {payload['charge_full_uAh'] // 1000} mAh")
-                print(f"Remaining capacity:  {payload['charge_now_uAh'] // 1000} mAh\n")
-                print(f"Voltage:             {bus_voltage_mV} mV (min. design: {BAT_VOLTAGE_EMPTY_mV} mV)")
-                print(f"Current:             {payload['current_avg_A']:.6f} A")
-                print(f"Power:               {power_W:.3f} W\n")
+                out.append("Battery values\n---------------------------------------------------")
+                out.append(f"bus_raw:             {bus_raw}")
+                out.append(f"bus_voltage:         {bus_voltage_mV} mV")
+                out.append(f"bus_voltage_avg:     {payload['bus_voltage_avg_mV']} mV\n")
+
+                out.append(f"shunt_raw:           {shunt_raw}")
+                out.append(f"shunt_voltage:       {shunt_voltage_mV:.3f} mV")
+                out.append(f"shunt_voltage_avg:   {est.hist.mean(1) / 100:.3f} mV\n")
+
+                out.append(f"current_raw:         {current_raw}")
+                out.append(f"current:             {current_A:.6f} A")
+                out.append(f"current_avg:         {current_avg_A:.6f} A\n")
+
+                out.append(f"power:               {power_W:.3f} W")
+                out.append(f"power_avg:           {payload['power_avg_uW'] / 1e6:.3f} W\n")
+
+                out.append("Battery info\n---------------------------------------------------")
+                out.append(f"Design capacity:     {BAT_CAPACITY_mAh} mAh ({BAT_CELL_CAPACITY_mAh} mAh * {BAT_CELLS})")
+                out.append(f"Last max. capacity:  {payload['charge_full_uAh'] // 1000} mAh")
+                out.append(f"Remaining capacity:  {payload['charge_now_uAh'] // 1000} mAh\n")
+                out.append(f"Voltage:             {bus_voltage_mV} mV (min. design: {BAT_VOLTAGE_EMPTY_mV} mV)")
+                out.append(f"Current:             {current_avg_A:.6f} A")
+                out.append(f"Power:               {power_W:.3f} W\n")
 
                 status_text = STATUS_MAP.get(payload['status_int'], 'n/a')
-                print(f"Status:              {status_text}")
-                print(f"Charge:              {payload['soc_pct']} %")
+                out.append(f"Status:              {status_text}")
+                out.append(f"Charge:              {payload['soc_pct']} %")
                 if payload['status_int'] == 0:
-                    print("Remaining time:      Fully charged\n")
+                    out.append("Remaining time:      Fully charged\n")
                 else:
-                    print(f"Remaining time:      {BatteryEstimator.human_time(payload['battery_remain_sec'])}\n")
+                    out.append(f"Remaining time:      {BatteryEstimator.human_time(payload['battery_remain_sec'])}\n")
 
-                print(f"Data written to {BATFILE}\n---------------------------------------------------\n")
+                out.append(f"Data written to {BATFILE}\n---------------------------------------------------\n")
+                sys.stdout.write("\n".join(out) + "\n")
+                sys.stdout.flush()
 
-            time.sleep(SAMPLE_PERIOD_S)
+            next_t += SAMPLE_PERIOD_S
+            dt = next_t - time.monotonic()
+            if dt > 0:
+                time.sleep(dt)
+            else:
+                # overran (e.g. slow I2C/disk); resync instead of bursting to catch up
+                next_t = time.monotonic()
 
     except KeyboardInterrupt:
         pass
     finally:
+        est.flush_calibration()
         ina.close()
 
 